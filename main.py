@@ -1,12 +1,27 @@
 # main.py
 import os
+import re
+import asyncio
+import math
 import time
+import random
+import hashlib
+import signal
+import secrets
 import threading
+from datetime import datetime, timedelta, timezone
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import msal
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 
 # --------------------------
 # SUCCESSFN
@@ -19,6 +34,54 @@ SUCCESSFN_POLL_SECONDS = 15          # SuccessFN every 15s
 SHAREPOINT_POLL_SECONDS = 300        # SharePoint every 5 minutes
 XRATES_POLL_SECONDS = 300            # XRATES every 5 minutes
 DISCOUNTS_POLL_SECONDS = 300         # Discounts every 5 minutes
+REFRESHER_TICK_SECONDS = 1           # background refresher wake-up interval
+
+# --------------------------
+# HTTP SESSIONS (keep-alive)
+# --------------------------
+class CappedRetry(Retry):
+    """
+    urllib3 Retry that waits at most retry_after_max seconds for a Retry-After.
+    """
+    def __init__(self, *args, retry_after_max=30, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.retry_after_max = retry_after_max
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.retry_after_max = self.retry_after_max
+        return retry
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, self.retry_after_max)
+
+
+def make_session(total=4, retry_after_max=30, allowed_methods=Retry.DEFAULT_ALLOWED_METHODS):
+    # exponential backoff (0, 1, 2, 4s) with jitter; 429/503 wait out Retry-After
+    # (capped) instead. Read timeouts are not retried: the caller's timeout is the bound.
+    retry = CappedRetry(
+        total=total,
+        read=0,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=allowed_methods,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+        retry_after_max=retry_after_max,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+    s = requests.Session()
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+_graph_session = make_session(allowed_methods={"GET", "POST", "PATCH"})  # $batch reads are POSTs
+# SuccessFN polls every 15s: two quick retries, never a long Retry-After sleep
+_sfn_session = make_session(total=2, retry_after_max=5)
+_sfn_session.headers["User-Agent"] = "Mozilla/5.0"
 
 # --------------------------
 # YOUR MATH (4 squares)
@@ -42,6 +105,17 @@ SILVER_SELL_ID = 6  # add this
 SILVER_MULT = 3.674
 SILVER_TO_KILO = 32.15
 
+# folded constants: 24K = gold / DIVISOR * MULT_A, 22K additionally * MULT_B
+_GOLD_A = MULT_A / DIVISOR
+_GOLD_B = MULT_A * MULT_B / DIVISOR
+_SILVER_K = SILVER_MULT * SILVER_TO_KILO
+
+# (key, gold factor, tag) per square, unpacked by the payload loop
+_ITEMS_SEQ = tuple(
+    (key, _GOLD_B if cfg["use_0916"] else _GOLD_A, cfg["tag"])
+    for key, cfg in ITEMS.items()
+)
+
 # --------------------------
 # DISCOUNTS SCREENS CONFIG
 # --------------------------
@@ -60,6 +134,7 @@ CLIENT_SECRET = os.environ["CLIENT_SECRET"]
 
 SP_HOST = os.environ.get("SP_HOST", "anvarluxuryjewellery.sharepoint.com")
 SP_SITE_PATH = os.environ.get("SP_SITE_PATH", "/sites/PRODUCTENTRY")
+SITE_ID_CACHE_FILE = os.environ.get("SITE_ID_CACHE_FILE", "/tmp/.dashboard_site_id")  # survives restarts
 
 # list for values (IDs 1..6 and 11..36)
 SP_LIST_NAME = os.environ.get("SP_LIST_NAME", "staffinstructions")
@@ -71,58 +146,171 @@ XRATES_LIST_NAME = os.environ.get("XRATES_LIST_NAME", "xrates")
 XRATES_RATE_FIELD = os.environ.get("XRATES_RATE_FIELD", "rate")
 XRATES_TYPE_FIELD = os.environ.get("XRATES_TYPE_FIELD", "type")
 
+# Graph change notifications (optional). When set to the public URL of
+# /api/graph-webhook, list edits invalidate the caches immediately and
+# polling drops to WEBHOOK_FALLBACK_POLL_SECONDS.
+GRAPH_WEBHOOK_URL = os.environ.get("GRAPH_WEBHOOK_URL", "")
+GRAPH_WEBHOOK_CLIENT_STATE = os.environ.get("GRAPH_WEBHOOK_CLIENT_STATE") or secrets.token_urlsafe(24)
+WEBHOOK_SUBSCRIPTION_MINUTES = 24 * 60   # subscription lifetime requested from Graph
+WEBHOOK_RENEW_SECONDS = 12 * 3600        # renew well before expiry
+WEBHOOK_RETRY_SECONDS = 300              # retry after a failed create/renew
+WEBHOOK_FALLBACK_POLL_SECONDS = 1800     # SharePoint poll interval while subscribed
+
 AUTHORITY = f"https://login.microsoftonline.com/{TENANT_ID}"
 SCOPE = ["https://graph.microsoft.com/.default"]
 
+GRAPH_BATCH_URL = "https://graph.microsoft.com/v1.0/$batch"
+GRAPH_BATCH_LIMIT = 20        # Graph accepts at most 20 subrequests per $batch
+GRAPH_BATCH_MAX_RETRIES = 3   # retries for throttled (429) subrequests
+GRAPH_BATCH_MAX_WAIT = 30     # cap on a single Retry-After sleep (seconds)
+
 msal_app = msal.ConfidentialClientApplication(
     client_id=CLIENT_ID,
     authority=AUTHORITY,
     client_credential=CLIENT_SECRET,
 )
 
-_access_token = None
-_token_expires_at = 0
+# MSAL keeps serving its cached token until it is within 5 minutes of expiry
+# (or past refresh_on), so the background prefetch runs once MSAL will really
+# issue a new one, and readers only block if that prefetch keeps failing.
+MSAL_CACHE_EXPIRY_BUFFER = 300  # MSAL's own "treat as expired" window
+TOKEN_REFRESH_MARGIN = 120      # readers treat the token as expired this long before it is
+TOKEN_RETRY_SECONDS = 30        # retry delay when a background refresh fails
 
+# (access_token, expires_at) with expires_at on time.monotonic(), published as
+# one tuple so readers never see a token paired with another token's expiry
+_token_ref = (None, 0)
+_token_lock = threading.Lock()
+_token_timer = None  # the one pending prefetch, guarded by _token_lock
 
-def get_access_token() -> str:
-    global _access_token, _token_expires_at
-    now = int(time.time())
-    if _access_token and now < (_token_expires_at - 60):
-        return _access_token
 
+def refresh_access_token() -> str:
+    global _token_ref
+    now = int(time.time())  # wall clock: refresh_on is an epoch timestamp
     result = msal_app.acquire_token_for_client(scopes=SCOPE)
     if "access_token" not in result:
         raise RuntimeError(f"Token error: {result}")
 
-    _access_token = result["access_token"]
-    _token_expires_at = now + int(result.get("expires_in", 3600))
-    return _access_token
+    token = result["access_token"]
+    lifetime = int(result.get("expires_in", 3600))
+    _graph_session.headers["Authorization"] = f"Bearer {token}"
+    _token_ref = (token, time.monotonic() + lifetime)
+
+    if "refresh_on" in result:
+        delay = int(result["refresh_on"]) - now
+    else:
+        delay = lifetime - MSAL_CACHE_EXPIRY_BUFFER + 1
+    schedule_token_prefetch(max(delay, TOKEN_RETRY_SECONDS))
+    return token
+
+
+def _prefetch_access_token():
+    with _token_lock:
+        try:
+            refresh_access_token()
+        except Exception:
+            schedule_token_prefetch(TOKEN_RETRY_SECONDS)
+
+
+def schedule_token_prefetch(delay: float):
+    # callers hold _token_lock; replacing the pending timer keeps a single prefetch chain
+    global _token_timer
+    if _token_timer is not None:
+        _token_timer.cancel()
+    _token_timer = threading.Timer(delay, _prefetch_access_token)
+    _token_timer.daemon = True
+    _token_timer.start()
+
+
+def get_access_token() -> str:
+    token, expires_at = _token_ref
+    if token and time.monotonic() < (expires_at - TOKEN_REFRESH_MARGIN):
+        return token
+
+    with _token_lock:
+        token, expires_at = _token_ref
+        if token and time.monotonic() < (expires_at - TOKEN_REFRESH_MARGIN):
+            return token
+        return refresh_access_token()
 
 
 def graph_get(url: str, timeout=25):
-    token = get_access_token()
-    headers = {"Authorization": f"Bearer {token}"}
-    r = requests.get(url, headers=headers, timeout=timeout)
+    get_access_token()
+    r = _graph_session.get(url, timeout=timeout)
+    r.raise_for_status()
+    return orjson.loads(r.content)
+
+
+def graph_send(method: str, url: str, body: dict, timeout=25):
+    get_access_token()
+    r = _graph_session.request(method, url, json=body, timeout=timeout)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
+
+
+def graph_batch(urls, timeout=25):
+    """
+    Sends relative Graph GET urls through $batch (GRAPH_BATCH_LIMIT per POST).
+    Returns (bodies, statuses) in the same order as urls; the body is None where
+    a subrequest failed. Throttled (429) subrequests are retried after their Retry-After.
+    """
+    get_access_token()
+    bodies = [None] * len(urls)
+    statuses = [0] * len(urls)
+
+    for start in range(0, len(urls), GRAPH_BATCH_LIMIT):
+        pending = list(range(start, min(start + GRAPH_BATCH_LIMIT, len(urls))))
+        attempt = 0
+        while pending:
+            payload = {
+                "requests": [
+                    {"id": str(i), "method": "GET", "url": urls[i]}
+                    for i in pending
+                ]
+            }
+            r = _graph_session.post(GRAPH_BATCH_URL, json=payload, timeout=timeout)
+            r.raise_for_status()
+
+            throttled = []
+            wait = 0.0
+            for resp in orjson.loads(r.content).get("responses", []):
+                i = int(resp["id"])
+                status = int(resp.get("status", 0))
+                headers = resp.get("headers") or {}
+                statuses[i] = status
+                if status == 429 and attempt < GRAPH_BATCH_MAX_RETRIES:
+                    throttled.append(i)
+                    retry_after = safe_float(headers.get("Retry-After"))
+                    wait = max(wait, retry_after or 1.0)
+                elif 200 <= status < 300:
+                    bodies[i] = resp.get("body") or {}
+
+            if throttled:
+                time.sleep(min(wait, GRAPH_BATCH_MAX_WAIT))
+            pending = sorted(throttled)
+            attempt += 1
+
+    return bodies, statuses
 
 
 # --------------------------
 # HELPERS
 # --------------------------
+# plain decimal / exponent numbers, i.e. what float() accepts minus nan/inf
+_NUM_RE = re.compile(r"\s*[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?\s*")
+
+
 def safe_float(x):
     if x is None:
         return None
-    s = str(x).strip().replace(",", "")
-    if not s:
-        return None
-    try:
-        v = float(s)
-        if v != v or v in (float("inf"), float("-inf")):
+    if isinstance(x, float):
+        v = x  # Graph returns number columns as JSON numbers
+    else:
+        s = (x if isinstance(x, str) else str(x)).replace(",", "")
+        if not _NUM_RE.fullmatch(s):
             return None
-        return v
-    except Exception:
-        return None
+        v = float(s)
+    return v if math.isfinite(v) else None
 
 
 def safe_str(x) -> str:
@@ -131,39 +319,65 @@ def safe_str(x) -> str:
     return str(x).strip()
 
 
-def parse_successfn_symbol(text: str, symbol: str):
-    records = text.replace("\r", "\n").split()
-    for rec in records:
-        parts = [p.strip() for p in rec.split(",")]
-        if len(parts) >= 2 and parts[0] == symbol:
-            return safe_float(parts[1])
-    return None
+# records are whitespace separated: "<SYMBOL>,<price>,..."
+_SUCCESSFN_RE = re.compile(
+    rf"(?<!\S)({re.escape(SUCCESSFN_GOLD_SYMBOL)}|{re.escape(SUCCESSFN_SILVER_SYMBOL)}),([^,\s]*)"
+)
 
 
-def fetch_successfn_prices():
-    r = requests.get(SUCCESSFN_API_URL, headers={"User-Agent": "Mozilla/5.0"}, timeout=20)
-    r.raise_for_status()
-    text = r.text.strip()
-    gold = parse_successfn_symbol(text, SUCCESSFN_GOLD_SYMBOL)
-    silver = parse_successfn_symbol(text, SUCCESSFN_SILVER_SYMBOL)
-    return gold, silver
+def parse_successfn_prices(text: str):
+    # one pass over the payload; stops once both symbols have been seen
+    prices = {}
+    for m in _SUCCESSFN_RE.finditer(text):
+        prices.setdefault(m.group(1), m.group(2))
+        if len(prices) == 2:
+            break
+    return (
+        safe_float(prices.get(SUCCESSFN_GOLD_SYMBOL)),
+        safe_float(prices.get(SUCCESSFN_SILVER_SYMBOL)),
+    )
 
 
-def compute_final_4squares(gold_val, sp_val, use_0916):
-    base = (gold_val / DIVISOR) * MULT_A
-    if use_0916:
-        base *= MULT_B
-    return base - sp_val
+def fetch_successfn_prices():
+    r = _sfn_session.get(SUCCESSFN_API_URL, timeout=20)
+    r.raise_for_status()
+    return parse_successfn_prices(r.text)
 
 
 def compute_kilo_silver(silver_val: float, delta: float):
-    return ((silver_val + delta) * SILVER_MULT) * SILVER_TO_KILO
+    return (silver_val + delta) * _SILVER_K
 
 
 # --------------------------
 # SHAREPOINT (Graph)
 # --------------------------
-_site_id_cache = None
+_SITE_ID_KEY = f"{SP_HOST}:{SP_SITE_PATH}"
+
+
+def load_site_id():
+    # site ids never change, so one resolved on a previous run can be reused
+    try:
+        with open(SITE_ID_CACHE_FILE, "r", encoding="utf-8") as f:
+            key, site_id = f.read().split("\n", 1)
+    except (OSError, ValueError):
+        return None
+    site_id = site_id.strip()
+    return site_id if key == _SITE_ID_KEY and site_id else None
+
+
+def save_site_id(site_id: str):
+    # write then rename, so a crash mid-write never leaves a truncated id behind
+    tmp_path = f"{SITE_ID_CACHE_FILE}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(f"{_SITE_ID_KEY}\n{site_id}")
+        os.replace(tmp_path, SITE_ID_CACHE_FILE)
+    except OSError:
+        pass
+
+
+_site_id_cache = load_site_id()
+_site_id_lock = threading.Lock()
 
 
 def fetch_site_id():
@@ -174,32 +388,105 @@ def fetch_site_id():
 def ensure_site_id():
     global _site_id_cache
     if not _site_id_cache:
-        _site_id_cache = fetch_site_id()
+        with _site_id_lock:
+            if not _site_id_cache:
+                _site_id_cache = fetch_site_id()
+                save_site_id(_site_id_cache)
     return _site_id_cache
 
 
-def fetch_item_fields(site_id: str, item_id: int):
-    url = (
-        f"https://graph.microsoft.com/v1.0/sites/{site_id}"
+# Graph answers these for a site id it doesn't (or no longer) know
+SITE_REJECTED_STATUSES = (400, 404)
+
+
+def forget_site_id():
+    # drop a rejected site id, in memory and on disk, so the next call resolves it again
+    global _site_id_cache
+    with _site_id_lock:
+        _site_id_cache = None
+        try:
+            os.remove(SITE_ID_CACHE_FILE)
+        except OSError:
+            pass
+
+
+def fetch_list_id(site_id: str, list_name: str):
+    url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/lists/{list_name}?$select=id"
+    try:
+        return graph_get(url)["id"]
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code in SITE_REJECTED_STATUSES:
+            forget_site_id()
+        raise
+
+
+def subscription_expiry():
+    expires = datetime.now(timezone.utc) + timedelta(minutes=WEBHOOK_SUBSCRIPTION_MINUTES)
+    return expires.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def create_list_subscription(site_id: str, list_id: str):
+    body = {
+        "changeType": "updated",
+        "notificationUrl": GRAPH_WEBHOOK_URL,
+        "resource": f"sites/{site_id}/lists/{list_id}",
+        "expirationDateTime": subscription_expiry(),
+        "clientState": GRAPH_WEBHOOK_CLIENT_STATE,
+    }
+    return graph_send("POST", "https://graph.microsoft.com/v1.0/subscriptions", body)["id"]
+
+
+def renew_list_subscription(subscription_id: str):
+    url = f"https://graph.microsoft.com/v1.0/subscriptions/{subscription_id}"
+    graph_send("PATCH", url, {"expirationDateTime": subscription_expiry()})
+
+
+# highest staffinstructions id the dashboard reads (values 1..6, discounts 11..36)
+STAFF_MAX_ID = max(
+    [cfg["id"] for cfg in ITEMS.values()]
+    + [SILVER_BUY_ID, SILVER_SELL_ID]
+    + [end_id for _, end_id in DISCOUNTS_SECTIONS.values()]
+)
+
+
+def staffinstructions_path(site_id: str):
+    # every staffinstructions row the dashboard needs, in one list query
+    return (
+        f"/sites/{site_id}"
         f"/lists/{SP_LIST_NAME}"
-        f"/items/{item_id}?expand=fields"
+        f"/items?$top={STAFF_MAX_ID}&$orderby=id asc&$select=id"
+        f"&$expand=fields($select=Title,{SP_COLUMN_NAME},{SP_CERTCHARGE_COLUMN})"
     )
-    data = graph_get(url)
-    return data.get("fields", {}) or {}
 
 
-def fetch_setval(site_id: str, item_id: int):
-    fields = fetch_item_fields(site_id, item_id)
-    return fields.get(SP_COLUMN_NAME, "")
+def parse_staffinstructions(data):
+    """
+    Returns {item_id: fields}.
+    """
+    out = {}
+    for it in data.get("value", []):
+        item_id = int(it.get("id", 0))
+        out[item_id] = it.get("fields", {}) or {}
+    return out
+
+
+def build_sharepoint_values(fields_by_id):
+    ids = {key: cfg["id"] for key, cfg in ITEMS.items()}
+    ids["SILVER_BUY_ID5"] = SILVER_BUY_ID
+    ids["SILVER_SELL_ID6"] = SILVER_SELL_ID
+    return {key: fields_by_id.get(item_id, {}).get(SP_COLUMN_NAME, "") for key, item_id in ids.items()}
 
 
-def fetch_xrates_top10(site_id: str):
-    url = (
-        f"https://graph.microsoft.com/v1.0/sites/{site_id}"
+def xrates_path(site_id: str):
+    return (
+        f"/sites/{site_id}"
         f"/lists/{XRATES_LIST_NAME}"
-        f"/items?$top=10&$orderby=id asc&expand=fields"
+        f"/items?$top=10&$orderby=id asc&$select=id"
+        f"&$expand=fields($select={XRATES_RATE_FIELD},{XRATES_TYPE_FIELD})"
     )
-    data = graph_get(url)
+
+
+def parse_xrates(data):
     items = data.get("value", [])
     out = []
     for it in items:
@@ -211,14 +498,43 @@ def fetch_xrates_top10(site_id: str):
     return out
 
 
-def fetch_discounts_section(site_id: str, section_name: str):
+def fetch_sharepoint_lists(site_id: str):
+    """
+    Reads staffinstructions and xrates in a single $batch round-trip.
+    Each list is stored as (rows, fetched_ts). A list whose subrequest failed keeps
+    its last good rows while they are within the stale limit, and is None after that.
+    """
+    (staff, xrates), statuses = graph_batch([staffinstructions_path(site_id), xrates_path(site_id)])
+    if staff is None and xrates is None:
+        if all(status in SITE_REJECTED_STATUSES for status in statuses):
+            forget_site_id()
+        raise RuntimeError("SharePoint batch failed")
+    now = time.monotonic()
+    max_age = sharepoint_ttl(SHAREPOINT_CACHE_SECONDS) * CACHE_MAX_STALE_FACTOR
+    previous = _sharepoint_cache["entry"][0] or {}
+
+    def carried(name):
+        last = previous.get(name)
+        return last if last is not None and now - last[1] < max_age else None
+
+    return {
+        "staff": carried("staff") if staff is None else (parse_staffinstructions(staff), now),
+        "xrates": carried("xrates") if xrates is None else (parse_xrates(xrates), now),
+    }
+
+
+def build_discounts_section(fields_by_id, section_name: str):
     if section_name not in DISCOUNTS_SECTIONS:
         return []
 
     start_id, end_id = DISCOUNTS_SECTIONS[section_name]
     rows = []
     for item_id in range(start_id, end_id + 1):
-        fields = fetch_item_fields(site_id, item_id)
+        fields = fields_by_id.get(item_id)
+        if fields is None:
+            # item deleted from the list: keep the row, don't fail the section
+            rows.append({"id": item_id, "type": "—", "disc": "—", "cert_charge": "—"})
+            continue
 
         typ = safe_str(fields.get("Title") or fields.get("title"))
         disc = safe_str(fields.get(SP_COLUMN_NAME))
@@ -236,83 +552,350 @@ def fetch_discounts_section(site_id: str, section_name: str):
 # --------------------------
 # FASTAPI
 # --------------------------
-app = FastAPI()
+class ORJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _stream_loop, _stream_cond
+    _stream_loop = asyncio.get_running_loop()
+    _stream_cond = asyncio.Condition()
+    hook_stream_shutdown()
+    start_refresher()
+    yield
+    _refresher_stop.set()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+app.add_middleware(GZipMiddleware, minimum_size=500)  # skips text/event-stream
+
+# index.html is static: read it once and let browsers revalidate by ETag
+with open("index.html", "rb") as f:
+    _INDEX_HTML = f.read()
+_INDEX_ETAG = f'"{hashlib.md5(_INDEX_HTML).hexdigest()}"'
+_INDEX_HEADERS = {"ETag": _INDEX_ETAG, "Cache-Control": "public, max-age=60"}
 
 
 @app.get("/", response_class=HTMLResponse)
-def home():
-    with open("index.html", "r", encoding="utf-8") as f:
-        return f.read()
+async def home(request: Request):
+    if_none_match = request.headers.get("if-none-match", "")
+    if _INDEX_ETAG in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=_INDEX_HEADERS)
+    return HTMLResponse(_INDEX_HTML, headers=_INDEX_HEADERS)
 
 
 # --------------------------
 # CACHES
 # --------------------------
-_lock = threading.Lock()
+# Each cache refreshes under its own lock (single-flight). Once a value exists,
+# refreshes happen early and in the background (XFetch): readers keep getting
+# the previous value while exactly one worker fetches the next one.
+CACHE_XFETCH_BETA = 1.0
+CACHE_MAX_STALE_FACTOR = 3  # past ttl * this, readers wait for a fresh value
+CACHE_TTL_JITTER = 0.1      # +/-10% per refresh so caches don't expire together
+CACHE_FAILURE_SECONDS = 10  # a failed refresh is remembered (not retried) this long
+CACHE_WAIT_SECONDS = 25     # longest a reader waits on another caller's refresh
 
-_success_cache = {"gold": None, "silver": None, "ts": 0.0}
-_sharepoint_cache = {"vals": None, "ts": 0.0}
-_xrates_cache = {"items": None, "ts": 0.0}
+# runs independent upstream fetches and background cache refreshes
+_fetch_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="fetch")
 
-# Discounts cache: per-section
-_discounts_cache = {
-    "PAMP": {"rows": None, "ts": 0.0},
-    "LOCAL": {"rows": None, "ts": 0.0},
-    "VALCAMBI": {"rows": None, "ts": 0.0},
-}
+
+# "entry" is (value, ts, expires_at), replaced as one tuple so lock-free readers
+# never pair a new value with an old timestamp.
+EMPTY_ENTRY = (None, 0.0, 0.0)
+
+
+def make_cache():
+    return {
+        "entry": EMPTY_ENTRY,
+        "delta": 0.0,
+        "failed_ts": -math.inf,
+        "error": None,
+        "generation": 0,  # bumped by invalidation, so a refresh already in flight can tell
+        "lock": threading.Lock(),
+    }
+
+
+_success_cache = make_cache()
+# staffinstructions rows (values 1..6 + discounts 11..36) and xrates, fetched together,
+# each as (rows, fetched_ts)
+_sharepoint_cache = make_cache()
+
+SHAREPOINT_CACHE_SECONDS = min(SHAREPOINT_POLL_SECONDS, DISCOUNTS_POLL_SECONDS, XRATES_POLL_SECONDS)
+
+
+def refresh_cache(cache, ttl, fetch):
+    started = time.monotonic()
+    generation = cache["generation"]
+    try:
+        value = fetch()
+    except Exception as e:
+        cache["failed_ts"] = time.monotonic()
+        cache["error"] = e
+        raise
+    now = time.monotonic()
+    expires_at = now + ttl * (1 + random.uniform(-CACHE_TTL_JITTER, CACHE_TTL_JITTER))
+    if cache["generation"] != generation:
+        expires_at = 0.0  # invalidated mid-fetch: the value may predate the change
+    cache["entry"] = (value, now, expires_at)
+    cache["delta"] = now - started
+    return value
+
+
+def _background_refresh(cache, ttl, fetch):
+    try:
+        refresh_cache(cache, ttl, fetch)
+    except Exception:
+        pass  # keep serving the previous value
+    finally:
+        cache["lock"].release()
+
+
+def schedule_refresh(cache, ttl, fetch):
+    # no-op when a refresh of this cache is already running
+    if cache["lock"].acquire(blocking=False):
+        _fetch_pool.submit(_background_refresh, cache, ttl, fetch)
+
+
+def read_cache(cache, ttl, fetch):
+    now = time.monotonic()
+    value, ts, expires_at = cache["entry"]
+    if value is None or now - ts >= ttl * CACHE_MAX_STALE_FACTOR:
+        # single-flight: the first caller fetches, the rest wait for its result
+        if not cache["lock"].acquire(timeout=CACHE_WAIT_SECONDS):
+            raise TimeoutError("cache refresh still running")
+        try:
+            now = time.monotonic()
+            value, ts, expires_at = cache["entry"]
+            if value is None or now - ts >= ttl * CACHE_MAX_STALE_FACTOR:
+                if now - cache["failed_ts"] < CACHE_FAILURE_SECONDS:
+                    # negative cache: don't hammer a failing upstream. A fresh exception per
+                    # reader, so the cached one doesn't collect every reader's traceback.
+                    raise RuntimeError("upstream refresh failed recently") from cache["error"]
+                return refresh_cache(cache, ttl, fetch)
+        finally:
+            cache["lock"].release()
+        return value
+
+    # XFetch: refresh early with a probability that grows as expiry nears
+    early = -cache["delta"] * CACHE_XFETCH_BETA * math.log(1.0 - random.random())
+    if now + early >= expires_at:
+        schedule_refresh(cache, ttl, fetch)
+    return value
+
+
+def peek_cache(cache, ttl):
+    # the value read_cache() would return without waiting on upstream, else None
+    value, ts, _ = cache["entry"]
+    if value is not None and time.monotonic() - ts < ttl * CACHE_MAX_STALE_FACTOR:
+        return value
+    return None
+
+
+def cache_ready(cache, ttl):
+    return peek_cache(cache, ttl) is not None
+
+
+def peek_sharepoint_lists():
+    # None when serving the lists would need a site lookup or an upstream fetch
+    if not _site_id_cache:
+        return None
+    return peek_cache(_sharepoint_cache, sharepoint_ttl(SHAREPOINT_CACHE_SECONDS))
+
+
+def sharepoint_ready():
+    return peek_sharepoint_lists() is not None
 
 
 def get_success_values():
-    now = time.time()
-    if _success_cache["gold"] is not None and (now - _success_cache["ts"]) < SUCCESSFN_POLL_SECONDS:
-        return _success_cache["gold"], _success_cache["silver"]
+    return read_cache(_success_cache, SUCCESSFN_POLL_SECONDS, fetch_successfn_prices)
+
+
+def get_sharepoint_lists(site_id: str):
+    ttl = sharepoint_ttl(SHAREPOINT_CACHE_SECONDS)
+    return read_cache(_sharepoint_cache, ttl, lambda: fetch_sharepoint_lists(site_id))
 
-    gold, silver = fetch_successfn_prices()
-    _success_cache["gold"] = gold
-    _success_cache["silver"] = silver
-    _success_cache["ts"] = now
-    return gold, silver
 
+# --------------------------
+# GRAPH CHANGE NOTIFICATIONS
+# --------------------------
+_webhook_subscriptions = {}  # list name -> Graph subscription id
+_webhook_state = {"next_run": 0.0}
+_webhook_lock = threading.Lock()  # one upkeep run at a time
+WEBHOOK_LISTS = (SP_LIST_NAME, XRATES_LIST_NAME)
 
-def get_sharepoint_values(site_id: str):
-    now = time.time()
-    if _sharepoint_cache["vals"] is not None and (now - _sharepoint_cache["ts"]) < SHAREPOINT_POLL_SECONDS:
-        return _sharepoint_cache["vals"]
 
-    vals = {}
-    for key, cfg in ITEMS.items():
-        vals[key] = fetch_setval(site_id, cfg["id"])
+def sharepoint_ttl(ttl):
+    # while Graph pushes changes for both lists, polling is only a fallback
+    return WEBHOOK_FALLBACK_POLL_SECONDS if len(_webhook_subscriptions) == len(WEBHOOK_LISTS) else ttl
 
-    vals["SILVER_BUY_ID5"] = fetch_setval(site_id, SILVER_BUY_ID)
-    vals["SILVER_SELL_ID6"] = fetch_setval(site_id, SILVER_SELL_ID)
 
-    _sharepoint_cache["vals"] = vals
-    _sharepoint_cache["ts"] = now
-    return vals
+def maintain_subscriptions(site_id: str):
+    # per list, so ids Graph already created are never forgotten (and duplicated)
+    # when another list's create or renew fails
+    failed = False
+    for list_name in WEBHOOK_LISTS:
+        subscription_id = _webhook_subscriptions.get(list_name)
+        try:
+            if subscription_id:
+                renew_list_subscription(subscription_id)
+            else:
+                list_id = fetch_list_id(site_id, list_name)
+                _webhook_subscriptions[list_name] = create_list_subscription(site_id, list_id)
+        except requests.HTTPError as e:
+            failed = True
+            if subscription_id and e.response is not None and e.response.status_code == 404:
+                del _webhook_subscriptions[list_name]  # lapsed at Graph: create a new one
+        except Exception:
+            failed = True
+    delay = WEBHOOK_RETRY_SECONDS if failed else WEBHOOK_RENEW_SECONDS
+    _webhook_state["next_run"] = time.monotonic() + delay
 
 
-def get_xrates(site_id: str):
-    now = time.time()
-    if _xrates_cache["items"] is not None and (now - _xrates_cache["ts"]) < XRATES_POLL_SECONDS:
-        return _xrates_cache["items"]
+def _run_subscription_upkeep(site_id: str):
+    try:
+        maintain_subscriptions(site_id)
+    finally:
+        _webhook_lock.release()
 
-    items = fetch_xrates_top10(site_id)
-    _xrates_cache["items"] = items
-    _xrates_cache["ts"] = now
-    return items
 
+def schedule_subscription_upkeep(site_id: str):
+    # Graph calls run on the fetch pool, never on the refresher thread
+    if not GRAPH_WEBHOOK_URL or time.monotonic() < _webhook_state["next_run"]:
+        return
+    if _webhook_lock.acquire(blocking=False):
+        _fetch_pool.submit(_run_subscription_upkeep, site_id)
 
-def get_discounts_section(site_id: str, section_name: str):
-    now = time.time()
-    cache = _discounts_cache.get(section_name)
-    if cache and cache["rows"] is not None and (now - cache["ts"]) < DISCOUNTS_POLL_SECONDS:
-        return cache["rows"]
 
-    rows = fetch_discounts_section(site_id, section_name)
-    if cache is not None:
-        cache["rows"] = rows
-        cache["ts"] = now
-    return rows
+def invalidate_sharepoint_cache():
+    # both lists share one cache; the refresher reloads it on its next tick
+    _sharepoint_cache["generation"] += 1
+    value, ts, _ = _sharepoint_cache["entry"]
+    _sharepoint_cache["entry"] = (value, ts, 0.0)
+
+
+# --------------------------
+# LIVE STREAM (SSE)
+# --------------------------
+# The refresher publishes the /api/values payload here whenever it changes;
+# /api/stream clients wait on one condition and each gets the same bytes,
+# and /api/values serves them as-is while the prices behind them are fresh.
+STREAM_KEEPALIVE_SECONDS = 15
+SERVED_VALUES_MAX_AGE = SUCCESSFN_POLL_SECONDS * CACHE_MAX_STALE_FACTOR
+
+# (latest /api/values body, ts of the SuccessFN entry it was rendered from):
+# reassigned whole, so readers take it without a lock
+_served_values = (b"", -math.inf)
+_stream_state = {"version": 0, "closing": False}
+_stream_loop = None
+_stream_cond = None
+
+
+async def _notify_stream():
+    async with _stream_cond:
+        _stream_cond.notify_all()
+
+
+def hook_stream_shutdown():
+    """
+    uvicorn waits for open responses before it runs the lifespan shutdown, so
+    an endless SSE response would hold every deploy until SIGKILL. Wrap the
+    server's exit-signal handlers to end the streams first.
+    """
+    def close_streams(signum, frame, previous):
+        _stream_state["closing"] = True
+        asyncio.run_coroutine_threadsafe(_notify_stream(), _stream_loop)
+        if callable(previous):
+            previous(signum, frame)
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        previous = signal.getsignal(sig)
+        try:
+            signal.signal(sig, lambda signum, frame, previous=previous: close_streams(signum, frame, previous))
+        except ValueError:
+            pass  # not on the main thread (e.g. a test client): nothing to hook
+
+
+def served_values_fresh(served) -> bool:
+    return time.monotonic() - served[1] < SERVED_VALUES_MAX_AGE
+
+
+def publish_values():
+    global _served_values
+    # renders straight from the cache entries, so the refresher never blocks here;
+    # when a cache is cold or too stale nothing is published and the body ages out
+    prices, prices_ts, _ = _success_cache["entry"]
+    lists = peek_sharepoint_lists()
+    if lists is None or not cache_ready(_success_cache, SUCCESSFN_POLL_SECONDS):
+        return
+    payload = render_values(prices, lists)
+    changed = payload != _served_values[0]
+    _served_values = (payload, prices_ts)
+    if not changed:
+        return
+    _stream_state["version"] += 1
+    if _stream_loop is not None:
+        asyncio.run_coroutine_threadsafe(_notify_stream(), _stream_loop)
+
+
+# --------------------------
+# BACKGROUND REFRESHER
+# --------------------------
+# Keeps every cache warm so request handlers are served from memory.
+_refresher_stop = threading.Event()
+
+
+def warm_cache(cache, ttl, fetch):
+    now = time.monotonic()
+    if now - cache["failed_ts"] < CACHE_FAILURE_SECONDS:
+        return
+    value, _, expires_at = cache["entry"]
+    if value is None or now + REFRESHER_TICK_SECONDS >= expires_at:
+        schedule_refresh(cache, ttl, fetch)
+
+
+_site_lookup = {"failed_ts": -math.inf, "lock": threading.Lock()}
+
+
+def _run_site_lookup():
+    try:
+        ensure_site_id()
+    except Exception:
+        _site_lookup["failed_ts"] = time.monotonic()
+    finally:
+        _site_lookup["lock"].release()
+
+
+def schedule_site_lookup():
+    # like warm_cache: one lookup at a time on the fetch pool, none while a failure is recent
+    if time.monotonic() - _site_lookup["failed_ts"] < CACHE_FAILURE_SECONDS:
+        return
+    if _site_lookup["lock"].acquire(blocking=False):
+        _fetch_pool.submit(_run_site_lookup)
+
+
+def refresh_loop():
+    while not _refresher_stop.is_set():
+        warm_cache(_success_cache, SUCCESSFN_POLL_SECONDS, fetch_successfn_prices)
+        site_id = _site_id_cache
+        if not site_id:
+            schedule_site_lookup()  # SharePoint work waits for a tick that has the id
+        else:
+            schedule_subscription_upkeep(site_id)
+            ttl = sharepoint_ttl(SHAREPOINT_CACHE_SECONDS)
+            warm_cache(_sharepoint_cache, ttl, lambda: fetch_sharepoint_lists(site_id))
+        try:
+            publish_values()
+        except Exception:
+            pass
+        _refresher_stop.wait(REFRESHER_TICK_SECONDS)
+
+
+def start_refresher():
+    _refresher_stop.clear()
+    threading.Thread(target=refresh_loop, name="cache-refresher", daemon=True).start()
 
 
 def blank_payload(status: str):
@@ -327,62 +910,174 @@ def blank_payload(status: str):
     }
 
 
+# error payloads never change, so encode them once
+_BLANKS = {
+    status: orjson.dumps(blank_payload(status))
+    for status in (
+        "SHAREPOINT ERROR (SITE)",
+        "SHAREPOINT ERROR (LIST)",
+        "SUCCESSFN ERROR (LLGUSD)",
+        "SUCCESSFN ERROR (LLSUSD)",
+    )
+}
+
+
+# last rendered /api/values body, keyed by the cache values it was built from
+_rendered_values = {"entry": (None, None, b"")}
+
+
+def build_values_payload() -> bytes:
+    try:
+        site_id = ensure_site_id()
+    except Exception:
+        return _BLANKS["SHAREPOINT ERROR (SITE)"]
+
+    try:
+        # cold SharePoint cache: fetch it alongside SuccessFN instead of after it
+        sharepoint_fut = None if sharepoint_ready() else _fetch_pool.submit(get_sharepoint_lists, site_id)
+
+        prices = get_success_values()
+        if None in prices:
+            return render_values(prices, None)  # SuccessFN error payload; no SharePoint needed
+
+        lists = sharepoint_fut.result() if sharepoint_fut else get_sharepoint_lists(site_id)
+        return render_values(prices, lists)
+    except Exception:
+        return _BLANKS["SHAREPOINT ERROR (LIST)"]
+
+
+def render_values(prices, lists) -> bytes:
+    gold_val, silver_val = prices
+    if gold_val is None:
+        return _BLANKS["SUCCESSFN ERROR (LLGUSD)"]
+    if silver_val is None:
+        return _BLANKS["SUCCESSFN ERROR (LLSUSD)"]
+
+    # cache entries are replaced on refresh, so identity means nothing changed
+    rendered_prices, rendered_lists, body = _rendered_values["entry"]
+    if prices is rendered_prices and lists is rendered_lists:
+        return body
+
+    try:
+        if lists["staff"] is None:
+            return _BLANKS["SHAREPOINT ERROR (LIST)"]
+        raw_map = build_sharepoint_values(lists["staff"][0])
+        out = {"status": "OK"}
+
+        for key, gold_k, tag in _ITEMS_SEQ:
+            sp_val = safe_float(raw_map.get(key))
+            if sp_val is None:
+                out[key] = {"tag": tag, "value": "INVALID"}
+                continue
+            final = gold_val * gold_k - sp_val
+            out[key] = {"tag": tag, "value": f"{final:,.0f}"}
+
+        id5 = safe_float(raw_map.get("SILVER_BUY_ID5"))
+        id6 = safe_float(raw_map.get("SILVER_SELL_ID6"))
+
+        out["silver_buy"] = "INVALID" if id5 is None else f"{compute_kilo_silver(silver_val, -id5):,.0f}"
+        out["silver_sell"] = "INVALID" if id6 is None else f"{compute_kilo_silver(silver_val, +id6):,.0f}"
+
+        body = orjson.dumps(out)
+        _rendered_values["entry"] = (prices, lists, body)
+        return body
+    except Exception:
+        return _BLANKS["SHAREPOINT ERROR (LIST)"]
+
+
+# Handlers answer inline on the event loop from what is already cached (the
+# published body, peek_sharepoint_lists) and only move to the threadpool when
+# a read would wait on upstream.
 @app.get("/api/values")
-def api_values():
-    with _lock:
-        try:
-            site_id = ensure_site_id()
-        except Exception:
-            return JSONResponse(blank_payload("SHAREPOINT ERROR (SITE)"))
+async def api_values():
+    # the refresher re-renders this every tick; a cold start or a stalled
+    # refresher (body older than SERVED_VALUES_MAX_AGE) builds it here instead
+    served = _served_values
+    if served_values_fresh(served):
+        return Response(served[0], media_type="application/json")
+    return Response(await run_in_threadpool(build_values_payload), media_type="application/json")
 
-        try:
-            gold_val, silver_val = get_success_values()
-            if gold_val is None:
-                return JSONResponse(blank_payload("SUCCESSFN ERROR (LLGUSD)"))
-            if silver_val is None:
-                payload = blank_payload("SUCCESSFN ERROR (LLSUSD)")
-                payload["status"] = "SUCCESSFN ERROR (LLSUSD)"
-                return JSONResponse(payload)
-
-            raw_map = get_sharepoint_values(site_id)
-            out = {"status": "OK"}
-
-            for key, cfg in ITEMS.items():
-                sp_val = safe_float(raw_map.get(key))
-                if sp_val is None:
-                    out[key] = {"tag": cfg["tag"], "value": "INVALID"}
-                    continue
-                final = compute_final_4squares(gold_val, sp_val, cfg["use_0916"])
-                out[key] = {"tag": cfg["tag"], "value": f"{final:,.0f}"}
-
-            id5 = safe_float(raw_map.get("SILVER_BUY_ID5"))
-            id6 = safe_float(raw_map.get("SILVER_SELL_ID6"))
-
-            out["silver_buy"] = "INVALID" if id5 is None else f"{compute_kilo_silver(silver_val, -id5):,.0f}"
-            out["silver_sell"] = "INVALID" if id6 is None else f"{compute_kilo_silver(silver_val, +id6):,.0f}"
-
-            return JSONResponse(out)
-        except Exception:
-            return JSONResponse(blank_payload("SHAREPOINT ERROR (LIST)"))
+
+@app.get("/api/stream")
+async def api_stream():
+    """
+    Server-sent events carrying the /api/values payload, pushed only when it changes.
+    """
+    async def events():
+        version = 0
+        while not _stream_state["closing"]:
+            try:
+                async with _stream_cond:
+                    await asyncio.wait_for(
+                        _stream_cond.wait_for(
+                            lambda: _stream_state["version"] != version or _stream_state["closing"]
+                        ),
+                        STREAM_KEEPALIVE_SECONDS,
+                    )
+            except asyncio.TimeoutError:
+                if served_values_fresh(_served_values):
+                    yield b": keep-alive\n\n"
+                else:
+                    # refresher stalled: don't leave clients on an old price
+                    yield b"data: " + await run_in_threadpool(build_values_payload) + b"\n\n"
+                continue
+            if _stream_state["closing"]:
+                break  # server shutting down; EventSource reconnects to the next instance
+            version = _stream_state["version"]
+            yield b"data: " + _served_values[0] + b"\n\n"
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+
+def build_xrates_payload():
+    try:
+        site_id = ensure_site_id()
+    except Exception:
+        return {"status": "SHAREPOINT ERROR (SITE)", "items": []}
+
+    try:
+        return xrates_payload(get_sharepoint_lists(site_id))
+    except Exception:
+        return {"status": "SHAREPOINT ERROR (XRATES)", "items": []}
+
+
+def xrates_payload(lists):
+    if lists["xrates"] is None:
+        return {"status": "SHAREPOINT ERROR (XRATES)", "items": []}
+    return {"status": "OK", "items": lists["xrates"][0]}
 
 
 @app.get("/api/xrates")
-def api_xrates():
-    with _lock:
-        try:
-            site_id = ensure_site_id()
-        except Exception:
-            return JSONResponse({"status": "SHAREPOINT ERROR (SITE)", "items": []})
+async def api_xrates():
+    lists = peek_sharepoint_lists()
+    if lists is not None:
+        return ORJSONResponse(xrates_payload(lists))
+    return ORJSONResponse(await run_in_threadpool(build_xrates_payload))
 
-        try:
-            items = get_xrates(site_id)
-            return JSONResponse({"status": "OK", "items": items})
-        except Exception:
-            return JSONResponse({"status": "SHAREPOINT ERROR (XRATES)", "items": []})
+
+def build_discounts_payload(sec: str):
+    try:
+        site_id = ensure_site_id()
+    except Exception:
+        return {"status": "SHAREPOINT ERROR (SITE)", "section": sec, "rows": []}
+
+    try:
+        return discounts_payload(get_sharepoint_lists(site_id), sec)
+    except Exception:
+        return {"status": "SHAREPOINT ERROR (DISCOUNTS)", "section": sec, "rows": []}
+
+
+def discounts_payload(lists, sec: str):
+    if sec not in DISCOUNTS_SECTIONS:
+        return {"status": "INVALID SECTION", "section": sec, "rows": []}
+    if lists["staff"] is None:
+        return {"status": "SHAREPOINT ERROR (DISCOUNTS)", "section": sec, "rows": []}
+    return {"status": "OK", "section": sec, "rows": build_discounts_section(lists["staff"][0], sec)}
 
 
 @app.get("/api/discounts/{section_name}")
-def api_discounts(section_name: str):
+async def api_discounts(section_name: str):
     """
     Returns one section per screen:
     - /api/discounts/PAMP     IDs 11..21
@@ -390,17 +1085,28 @@ def api_discounts(section_name: str):
     - /api/discounts/VALCAMBI IDs 29..36
     """
     sec = (section_name or "").strip().upper()
-    with _lock:
-        try:
-            site_id = ensure_site_id()
-        except Exception:
-            return JSONResponse({"status": "SHAREPOINT ERROR (SITE)", "section": sec, "rows": []})
+    lists = peek_sharepoint_lists()
+    if lists is not None:
+        return ORJSONResponse(discounts_payload(lists, sec))
+    return ORJSONResponse(await run_in_threadpool(build_discounts_payload, sec))
 
-        try:
-            if sec not in DISCOUNTS_SECTIONS:
-                return JSONResponse({"status": "INVALID SECTION", "section": sec, "rows": []})
 
-            rows = get_discounts_section(site_id, sec)
-            return JSONResponse({"status": "OK", "section": sec, "rows": rows})
-        except Exception:
-            return JSONResponse({"status": "SHAREPOINT ERROR (DISCOUNTS)", "section": sec, "rows": []})
+@app.post("/api/graph-webhook")
+async def graph_webhook(request: Request):
+    """
+    Graph change notifications for the staffinstructions / xrates lists.
+    Echoes validationToken on subscription, otherwise invalidates the cache.
+    """
+    validation_token = request.query_params.get("validationToken")
+    if validation_token is not None:
+        return PlainTextResponse(validation_token)
+
+    try:
+        notes = orjson.loads(await request.body()).get("value", [])
+    except Exception:
+        return Response(status_code=400)
+
+    for note in notes:
+        if secrets.compare_digest(safe_str(note.get("clientState")), GRAPH_WEBHOOK_CLIENT_STATE):
+            invalidate_sharepoint_cache()
+    return Response(status_code=202)